@@ -1,10 +1,14 @@
+import numpy as np
+
 import torch
 from torch import Tensor
+import torch.nn.functional as Fun
 from torch.utils.data import Dataset
 
+import pyarrow.compute as pc
 from tokenizers import Tokenizer
 
-from nmt.constants import SpecialToken
+from nmt.constants import DatasetFeature, SpecialToken
 
 
 class BilingualDataset(Dataset):
@@ -35,48 +39,105 @@ class BilingualDataset(Dataset):
         self.eos_token_id = src_tokenizer.token_to_id(SpecialToken.EOS)
         self.pad_token_id = src_tokenizer.token_to_id(SpecialToken.PAD)
 
+        # token ids (computed during preprocessing) of the whole dataset are packed once
+        # into flat tensors with <SOS> and <EOS> tokens already in place,
+        # so that `__getitem__` only has to slice them
+        src_token_ids, src_lengths = self._read_token_ids(DatasetFeature.SRC_TOKEN_IDS)
+        target_token_ids, target_lengths = self._read_token_ids(DatasetFeature.TARGET_TOKEN_IDS)
+
+        self.encoder_inputs, self.encoder_offsets = _pack_token_ids(
+            src_token_ids, src_lengths,
+            sos_token_id=self.sos_token_id, eos_token_id=self.eos_token_id, dtype=np.int32,
+        )
+        self.decoder_inputs, self.decoder_offsets = _pack_token_ids(
+            target_token_ids, target_lengths,
+            sos_token_id=self.sos_token_id, dtype=np.int32,
+        )
+        self.labels, _ = _pack_token_ids(
+            target_token_ids, target_lengths,
+            eos_token_id=self.eos_token_id,
+            dtype=np.int64,  # int32 has a problem with nll loss forward on cuda
+        )  # labels have the same offsets as decoder inputs
+
+        # lengths of the encoder inputs and decoder inputs (or labels) of each example
+        self.src_lengths = src_lengths + 2
+        self.target_lengths = target_lengths + 1
+
+    def _read_token_ids(self, feature: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            tuple[np.ndarray, np.ndarray]: concatenated token ids of all rows and the number of tokens of each row
+        """
+        token_ids = self.dataset.with_format('arrow')[feature]
+        lengths = pc.list_value_length(token_ids).to_numpy().astype(np.int64)
+        values = pc.list_flatten(token_ids).to_numpy()
+        return values, lengths
+
     def __len__(self):
-        return len(self.dataset)
+        return len(self.src_lengths)
 
     def __getitem__(self, index):
-        src_text = self.dataset[index][self.source]
-        target_text = self.dataset[index][self.target]
-
-        encode_input_tokens = self.src_tokenizer.encode(src_text).ids
-        decode_input_tokens = self.target_tokenizer.encode(target_text).ids
+        encoder_start, encoder_end = self.encoder_offsets[index], self.encoder_offsets[index + 1]
+        decoder_start, decoder_end = self.decoder_offsets[index], self.decoder_offsets[index + 1]
+        encoder_input = self.encoder_inputs[encoder_start:encoder_end]
+        decoder_input = self.decoder_inputs[decoder_start:decoder_end]
+        labels = self.labels[decoder_start:decoder_end]
 
-        encode_num_paddings, decode_num_paddings = 0, 0
         if self.add_padding_tokens:
-            encode_num_paddings = self.seq_length - len(encode_input_tokens) - 2  # exclude <SOS> & <EOS>
-            decode_num_paddings = self.seq_length - len(decode_input_tokens) - 1  # exclude <SOS> | <EOS>
-
-        assert encode_num_paddings >= 0, "The length of the source text is too long"
-        assert decode_num_paddings >= 0, "The length of the target text is too long"
-
-        encoder_input = torch.cat([
-            Tensor([self.sos_token_id]),
-            Tensor(encode_input_tokens),
-            Tensor([self.eos_token_id]),
-            Tensor([self.pad_token_id]).repeat(encode_num_paddings)
-        ]).type(torch.int32)
-        decoder_input = torch.cat([
-            Tensor([self.sos_token_id]),
-            Tensor(decode_input_tokens),
-            Tensor([self.pad_token_id]).repeat(decode_num_paddings)
-        ]).type(torch.int32)
-        labels = torch.cat([
-            Tensor(decode_input_tokens),
-            Tensor([self.eos_token_id]),
-            Tensor([self.pad_token_id]).repeat(decode_num_paddings)
-        ]).type(torch.int64)  # int32 has a problem with nll loss forward on cuda
+            encode_num_paddings = self.seq_length - encoder_input.size(0)
+            decode_num_paddings = self.seq_length - decoder_input.size(0)
 
-        if self.add_padding_tokens:
-            assert encoder_input.size(0) == self.seq_length
-            assert decoder_input.size(0) == self.seq_length
-            assert labels.size(0) == self.seq_length
+            assert encode_num_paddings >= 0, "The length of the source text is too long"
+            assert decode_num_paddings >= 0, "The length of the target text is too long"
+
+            encoder_input = Fun.pad(encoder_input, (0, encode_num_paddings), value=self.pad_token_id)
+            decoder_input = Fun.pad(decoder_input, (0, decode_num_paddings), value=self.pad_token_id)
+            labels = Fun.pad(labels, (0, decode_num_paddings), value=self.pad_token_id)
 
         return {
             'encoder_input': encoder_input,
             'decoder_input': decoder_input,
             'labels': labels,
         }
+
+def _pack_token_ids(
+    token_ids: np.ndarray,
+    lengths: np.ndarray,
+    *,
+    sos_token_id: int | None = None,
+    eos_token_id: int | None = None,
+    dtype=np.int32,
+) -> tuple[Tensor, np.ndarray]:
+    """
+    Pack rows of token ids into a flat tensor, optionally surrounding each row with
+    ``sos_token_id`` and ``eos_token_id``
+
+    Args:
+        token_ids (np.ndarray): concatenated token ids of all rows
+        lengths (np.ndarray): number of tokens of each row
+        sos_token_id (int | None): token prepended to each row (default: None)
+        eos_token_id (int | None): token appended to each row (default: None)
+        dtype: dtype of the packed tensor (default: np.int32)
+
+    Returns:
+        tuple[Tensor, np.ndarray]: the packed tensor and the offsets of the rows in it,
+            row ``i`` is ``packed[offsets[i]:offsets[i + 1]]``
+    """
+    has_sos = int(sos_token_id is not None)
+    num_extra_tokens = has_sos + int(eos_token_id is not None)
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths + num_extra_tokens, out=offsets[1:])
+
+    packed = np.empty(offsets[-1], dtype=dtype)
+    if sos_token_id is not None:
+        packed[offsets[:-1]] = sos_token_id
+    if eos_token_id is not None:
+        packed[offsets[1:] - 1] = eos_token_id
+
+    # the j-th token of the i-th row goes to position (index in `token_ids`) + i * num_extra_tokens + has_sos
+    row_shifts = np.arange(len(lengths), dtype=np.int64) * num_extra_tokens + has_sos
+    positions = np.arange(len(token_ids), dtype=np.int64) + np.repeat(row_shifts, lengths)
+    packed[positions] = token_ids
+
+    return torch.from_numpy(packed), offsets
@@ -4,7 +4,6 @@ class SpecialToken:
     EOS = '<EOS>'
     PAD = '<PAD>'
     UNK = '<UNK>'
-    BPE_SUFFIX = '##'
     WORD_PIECE_PREFIX = '##'
 
 class TokenizerModel:
@@ -12,6 +11,10 @@ class TokenizerModel:
     BPE = 'bpe'
     WORD_PIECE = 'word_piece'
 
+class DatasetFeature:
+    SRC_TOKEN_IDS = 'src_token_ids'
+    TARGET_TOKEN_IDS = 'target_token_ids'
+
 class Config:
     LOWERCASE = 'lowercase'
     CONTRACTIONS = 'contractions'
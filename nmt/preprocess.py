@@ -1,26 +1,42 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 from pathlib import Path
-from typing import Generator, Literal
+import shutil
+from typing import Literal
 
-from datasets import DatasetDict, load_dataset
+from datasets import Dataset, DatasetDict, load_dataset, load_from_disk
 import tokenizers
 from tokenizers import Tokenizer
 import tokenizers.decoders
 import tokenizers.models
-from tokenizers.pre_tokenizers import Whitespace
+from tokenizers.pre_tokenizers import ByteLevel, Whitespace
 import tokenizers.trainers
 
-from nmt.constants import SpecialToken, TokenizerModel
+from nmt.constants import DatasetFeature, SpecialToken, TokenizerModel
 from nmt.utils import (
     config as config_util,
     dataset as dataset_util,
-    misc as misc_util,
 )
 from nmt.utils.logging import init_logger, logger
 from nmt.utils.misc import set_seed
 
 
+# options that affect the processed datasets (before removing invalid pairs)
+_DATASET_FINGERPRINT_KEYS = [
+    'dataset_path', 'dataset_name', 'data_files', 'dataset_config_kwags',
+    'val_size_rate', 'max_set_size', 'seed', 'source', 'target', 'preprocess',
+]
+# options that additionally affect the trained tokenizers
+_TOKENIZER_FINGERPRINT_KEYS = ['tokenizer_model', 'share_vocab', 'source_vocab_size', 'target_vocab_size']
+# hashed into every fingerprint, bump it whenever the output of `_load_datasets`,
+# `dataset_util.process_sentence` or `get_tokenizer_trainer` changes, so that stale caches are not reused
+_CACHE_VERSION = 1
+
+
 def get_tokenizer_trainer(
     tokenizer_model: str,
     *,
@@ -49,16 +65,18 @@ def get_tokenizer_trainer(
             special_tokens=all_special_tokens,
         )
     elif tokenizer_model == TokenizerModel.BPE:
+        # byte-level pre-tokenization: every byte is in the initial alphabet,
+        # so there are no OOV characters and no <UNK> tokens
         tokenizer = Tokenizer(tokenizers.models.BPE(unk_token=SpecialToken.UNK))
-        tokenizer.pre_tokenizer = Whitespace()
-        tokenizer.decoder = tokenizers.decoders.BPEDecoder(suffix=SpecialToken.BPE_SUFFIX)
+        tokenizer.pre_tokenizer = ByteLevel(add_prefix_space=True)
+        tokenizer.decoder = tokenizers.decoders.ByteLevel()
 
         trainer = tokenizers.trainers.BpeTrainer(
             vocab_size=vocab_size,
             min_frequency=min_freq,
             show_progress=show_progress,
             special_tokens=all_special_tokens,
-            end_of_word_suffix=SpecialToken.BPE_SUFFIX,
+            initial_alphabet=ByteLevel.alphabet(),
         )
     elif tokenizer_model == TokenizerModel.WORD_PIECE:
         tokenizer = Tokenizer(tokenizers.models.WordPiece(
@@ -84,28 +102,98 @@ def get_tokenizer_trainer(
     return tokenizer, trainer
 
 def tokenize(
-    data_iter: Generator[str, None, None],
-    feature: str,
+    dataset: Dataset,
+    features: list[str],
+    name: str,
     config: dict,
     *,
     vocab_size: int = 30_000,
     min_freq: int | Literal['default'] = 'default',
+    cache_dir: str | None = None,
 ) -> Tokenizer:
+    """
+    Train a tokenizer on the sentences of ``features`` in ``dataset`` and save it
+    as ``config['tokenizer_basename'].format(name)``.
+
+    If ``cache_dir`` contains a tokenizer trained with the same settings, it is
+    loaded instead of training a new one.
+
+    This function is kept at module level so that it can be submitted to a process pool.
+    """
     checkpoints_dir = Path(config['checkpoints_dir'])
-    tokenizer_path = checkpoints_dir / config['tokenizer_basename'].format(feature)
+    tokenizer_path = checkpoints_dir / config['tokenizer_basename'].format(name)
     checkpoints_dir.mkdir(parents=True, exist_ok=True)
 
+    cached_tokenizer_path = None
+    if cache_dir is not None:
+        cached_tokenizer_path = Path(cache_dir) / config['tokenizer_basename'].format(name)
+        if cached_tokenizer_path.exists():
+            logger.info('Loading cached tokenizer from %s', cached_tokenizer_path)
+            tokenizer = Tokenizer.from_file(str(cached_tokenizer_path))
+            tokenizer.save(str(tokenizer_path))
+            return tokenizer
+
     tokenizer, trainer = get_tokenizer_trainer(
         config['tokenizer_model'],
         vocab_size=vocab_size,
         min_freq=min_freq,
     )
 
-    tokenizer.train_from_iterator(data_iter, trainer=trainer)
+    data_iter = dataset_util.create_batch_iter_from_dataset(dataset, features)
+    tokenizer.train_from_iterator(data_iter, trainer=trainer, length=len(dataset) * len(features))
     tokenizer.save(str(tokenizer_path))
+    if cached_tokenizer_path is not None:
+        cached_tokenizer_path.parent.mkdir(parents=True, exist_ok=True)
+        tokenizer.save(str(cached_tokenizer_path))
 
     return tokenizer
 
+def _compute_fingerprint(config: dict, relevant_keys: list[str]) -> str:
+    """
+    Compute a fingerprint of the options ``relevant_keys`` in ``config``,
+    including the size and modification time of local data files
+    """
+    relevant_config = {key: config[key] for key in relevant_keys}
+    relevant_config['cache_version'] = _CACHE_VERSION
+
+    data_files = config['data_files']
+    if isinstance(data_files, dict):
+        data_files = list(data_files.values())
+    elif not isinstance(data_files, list):
+        data_files = [data_files]
+    data_files_stats = []
+    for data_file in data_files:
+        for file_path in (data_file if isinstance(data_file, list) else [data_file]):
+            if isinstance(file_path, str) and Path(file_path).is_file():
+                file_stat = Path(file_path).stat()
+                data_files_stats.append([file_path, file_stat.st_size, file_stat.st_mtime])
+    relevant_config['data_files_stats'] = data_files_stats
+
+    serialized_config = json.dumps(relevant_config, sort_keys=True, default=str)
+    return hashlib.sha1(serialized_config.encode()).hexdigest()[:12]
+
+def _load_processed_datasets(config: dict, cache_dir: Path) -> DatasetDict:
+    """
+    Load and process the datasets, the result is cached in ``cache_dir``
+    and reused by subsequent runs with the same fingerprint
+    """
+    processed_datasets_path = cache_dir / 'processed_datasets'
+    if processed_datasets_path.exists():
+        logger.info('Loading cached processed datasets from %s', processed_datasets_path)
+        return load_from_disk(str(processed_datasets_path))
+
+    raw_datasets = _load_datasets(config)
+    raw_datasets = dataset_util.process_dataset_sentences(raw_datasets, config)
+
+    # save to a temporary directory first, so an interrupted run never leaves a broken cache behind
+    tmp_path = cache_dir / 'processed_datasets.tmp'
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    raw_datasets.save_to_disk(str(tmp_path))
+    tmp_path.rename(processed_datasets_path)
+
+    return load_from_disk(str(processed_datasets_path))
+
 def _load_datasets(config: dict) -> DatasetDict:
     """
     Each dataset in the dataset dict should have two features: ``config['source']`` and ``config['target']``,
@@ -117,6 +205,15 @@ def _load_datasets(config: dict) -> DatasetDict:
         **config['dataset_config_kwags'],
     )
 
+    # drop the features that are not used, so that the following passes
+    # over the datasets do not have to read and write them
+    for split in raw_datasets:
+        features = [
+            feature for feature in [config['source'], config['target']]
+            if feature in raw_datasets[split].column_names
+        ]
+        raw_datasets[split] = raw_datasets[split].select_columns(features)
+
     # creating validation set from train set
     if config['val_size_rate'] is not None:
         old_datasets = raw_datasets
@@ -127,50 +224,131 @@ def _load_datasets(config: dict) -> DatasetDict:
         raw_datasets['test'] = old_datasets['test']
 
     # slicing the dataset
+    # (sampling indices directly is cheaper than shuffling the whole split then taking its head)
+    rng = np.random.default_rng(config['seed'])
     for split in raw_datasets:
         if split in config['max_set_size'] and config['max_set_size'][split] is not None:
             max_set_size = config['max_set_size'][split]
             if 0 < max_set_size and max_set_size < len(raw_datasets[split]):
-                raw_datasets[split] = raw_datasets[split].shuffle().select(range(max_set_size))
+                indices = rng.choice(len(raw_datasets[split]), size=max_set_size, replace=False)
+                # sorted, so that rows are read in storage order (batches are shuffled by the data loader anyway)
+                indices.sort()
+                raw_datasets[split] = raw_datasets[split].select(indices)
 
     return raw_datasets
 
+def _log_length_stats(
+    dataset: Dataset,
+    src_tokenizer: Tokenizer,
+    target_tokenizer: Tokenizer,
+    max_seq_length: int,
+    config: dict,
+    *,
+    num_samples: int = 10_000,
+) -> None:
+    """
+    Log the distribution of token lengths of a sample of ``dataset`` (encoded without truncation),
+    and the number of sentences of ``dataset`` longer than ``max_seq_length``,
+    useful for choosing ``src_seq_length`` and ``target_seq_length``
+    """
+    samples = dataset[:num_samples]
+    for name, feature, token_ids_feature, tokenizer in [
+        ('source', config['source'], DatasetFeature.SRC_TOKEN_IDS, src_tokenizer),
+        ('target', config['target'], DatasetFeature.TARGET_TOKEN_IDS, target_tokenizer),
+    ]:
+        lengths = np.array([len(encoding.ids) for encoding in tokenizer.encode_batch(samples[feature])])
+        if lengths.size == 0:
+            continue
+        # token ids of `dataset` are truncated to `max_seq_length + 1` tokens
+        num_too_long = np.count_nonzero(
+            dataset_util.get_token_lengths(dataset, token_ids_feature) > max_seq_length
+        )
+        logger.info(
+            'Token lengths of %s sentences: mean %.1f, p50 %d, p95 %d, p99 %d, max %d '
+            '(%d sampled sentences), %d/%d sentences are longer than %d tokens',
+            name,
+            lengths.mean(),
+            np.percentile(lengths, 50),
+            np.percentile(lengths, 95),
+            np.percentile(lengths, 99),
+            lengths.max(),
+            lengths.size,
+            num_too_long,
+            len(dataset),
+            max_seq_length,
+        )
+
 def preprocess(config: dict):
     set_seed(config['seed'])
     init_logger()
 
-    raw_datasets = _load_datasets(config)
+    cache_dir = Path(config['checkpoints_dir']) / 'cache' / _compute_fingerprint(config, _DATASET_FINGERPRINT_KEYS)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    logger.info('Using preprocessing cache directory %s', cache_dir)
+    tokenizer_fingerprint = _compute_fingerprint(
+        config,
+        _DATASET_FINGERPRINT_KEYS + _TOKENIZER_FINGERPRINT_KEYS,
+    )
+    tokenizer_cache_dir = cache_dir / f'tokenizers-{tokenizer_fingerprint}'
+
+    raw_datasets = _load_processed_datasets(config, cache_dir)
     num_rows = raw_datasets.num_rows
-    raw_datasets = dataset_util.process_dataset_sentences(raw_datasets, config)
 
     for split_name in ['train', 'validation', 'test']:
         if split_name in raw_datasets:
             logger.info(pd.DataFrame(raw_datasets[split_name][:5]))
 
     logger.info('Building tokenizers from train dataset')
+    train_dataset = raw_datasets['train']
     if config['share_vocab']:
-        data_iter = misc_util.combined_iterator(
-            raw_datasets['train'][config['source']],
-            raw_datasets['train'][config['target']],
+        src_tokenizer = tokenize(
+            train_dataset,
+            [config['source'], config['target']],
+            'combined',
+            config,
+            vocab_size=config['source_vocab_size'],
+            cache_dir=str(tokenizer_cache_dir),
         )
-        src_tokenizer = tokenize(data_iter, 'combined', config, vocab_size=config['source_vocab_size'])
         target_tokenizer = src_tokenizer
         logger.info('Size of vocabulary: %d', src_tokenizer.get_vocab_size())
     else:
-        src_data_iter = (item for item in raw_datasets['train'][config['source']])
-        target_data_iter = (item for item in raw_datasets['train'][config['target']])
-        src_tokenizer = tokenize(src_data_iter, config['source'], config, vocab_size=config['source_vocab_size'])
-        target_tokenizer = tokenize(target_data_iter, config['target'], config, vocab_size=config['target_vocab_size'])
+        # the two tokenizers are independent, so train them concurrently.
+        # `train_dataset` is memory-mapped from disk, so only references
+        # to its files are pickled to the workers
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            src_future = executor.submit(
+                tokenize,
+                train_dataset.select_columns(config['source']),
+                [config['source']],
+                config['source'],
+                config,
+                vocab_size=config['source_vocab_size'],
+                cache_dir=str(tokenizer_cache_dir),
+            )
+            target_future = executor.submit(
+                tokenize,
+                train_dataset.select_columns(config['target']),
+                [config['target']],
+                config['target'],
+                config,
+                vocab_size=config['target_vocab_size'],
+                cache_dir=str(tokenizer_cache_dir),
+            )
+            src_tokenizer = src_future.result()
+            target_tokenizer = target_future.result()
         logger.info('Size of src vocabulary: %d', src_tokenizer.get_vocab_size())
         logger.info('Size of target vocabulary: %d', target_tokenizer.get_vocab_size())
 
-    logger.info('Removing invalid pairs')
     num_reserved_tokens = 2  # for SOS and EOS tokens
-    raw_datasets = dataset_util.remove_invalid_pairs(raw_datasets,
-                                                     src_tokenizer,
-                                                     target_tokenizer,
-                                                     config['src_seq_length'] - num_reserved_tokens,
-                                                     config)
+    max_seq_length = config['src_seq_length'] - num_reserved_tokens
+
+    logger.info('Encoding sentences')
+    raw_datasets = dataset_util.encode_dataset_sentences(raw_datasets, src_tokenizer, target_tokenizer,
+                                                         config, max_seq_length=max_seq_length)
+    _log_length_stats(raw_datasets['train'], src_tokenizer, target_tokenizer, max_seq_length, config)
+
+    logger.info('Removing invalid pairs')
+    raw_datasets = dataset_util.remove_invalid_pairs(raw_datasets, max_seq_length)
 
     for dataset, num_row in raw_datasets.num_rows.items():
         if dataset in num_rows:
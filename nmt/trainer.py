@@ -93,8 +93,8 @@ class Trainer:
 
             # TODO: currently, this training does not care about the state of the data loader
             for batch in train_data_loader:
-                encoder_input = batch['encoder_input'].to(self.device)  # (batch_size, seq_length)
-                decoder_input = batch['decoder_input'].to(self.device)  # (batch_size, seq_length)
+                encoder_input = batch['encoder_input'].to(self.device, non_blocking=True)  # (batch_size, seq_length)
+                decoder_input = batch['decoder_input'].to(self.device, non_blocking=True)  # (batch_size, seq_length)
 
                 self.optimizer.zero_grad()
 
@@ -102,7 +102,7 @@ class Trainer:
                     decoder_output = self.model(encoder_input, decoder_input)  # (batch_size, seq_length, d_model)
                     logits = self.model.linear_transform(decoder_output)  # (batch_size, seq_length, target_vocab_size)
                     pred = logits.argmax(dim=-1)  # (batch_size, seq_length)
-                    labels = batch['labels'].to(self.device)  # (batch_size, seq_length)
+                    labels = batch['labels'].to(self.device, non_blocking=True)  # (batch_size, seq_length)
 
                     # calculate the loss
                     # logits: (batch_size * seq_length, target_vocab_size)
@@ -1,22 +1,37 @@
 import html
+import math
+import numpy as np
+import os
 from pathlib import Path
 import re
-from typing import Any
+from typing import Any, Generator, Iterator
 
+import torch
+from torch import Tensor
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 
 from datasets import Dataset, DatasetDict
+import pyarrow.compute as pc
 from tokenizers import Tokenizer
 
 import contractions
 import underthesea
 
 from nmt.billingual_dataset import BilingualDataset
-from nmt.constants import Config, SpecialToken
+from nmt.constants import Config, DatasetFeature, SpecialToken
 from nmt.utils.misc import is_enabled
 
 
+# compiled once at import time, also in each `map` worker process
+_SPACE_BEFORE_HTML_ENTITY_RE = re.compile(r'\s(&[a-zA-Z]+;)')
+_SPACE_BEFORE_CONTRACTION_RE = re.compile(r"\s('[\w\d]+)")
+
+# splits with fewer rows are processed in the main process,
+# as starting the worker processes would cost more than it saves
+_MIN_ROWS_FOR_MULTIPROCESSING = 10_000
+
+
 def make_data_loader(
     dataset: Dataset,
     src_tokenizer: Tokenizer,
@@ -41,8 +56,22 @@ def make_data_loader(
         pad_token_id,
         added_features=['encoder_input', 'decoder_input', 'labels']
     )
-    data_loader = DataLoader(bilingual_dataset, batch_size=batch_size,
-                             shuffle=shuffle, collate_fn=data_collator, pin_memory=True)
+    # examples of similar lengths are batched together, so that batches
+    # (padded to their longest example by the collator) contain few padding tokens
+    batch_sampler = LengthBucketSampler(
+        np.maximum(bilingual_dataset.src_lengths, bilingual_dataset.target_lengths),
+        batch_size,
+        shuffle=shuffle,
+    )
+
+    # batches are collated in worker processes and copied to pinned memory,
+    # so that they can be copied to the gpu with `non_blocking=True`
+    num_workers = config['num_workers']
+    data_loader = DataLoader(bilingual_dataset, batch_sampler=batch_sampler,
+                             collate_fn=data_collator, pin_memory=True,
+                             num_workers=num_workers,
+                             persistent_workers=num_workers > 0,
+                             prefetch_factor=4 if num_workers > 0 else None)
 
     return data_loader
 
@@ -57,16 +86,30 @@ def load_trained_tokenizers(config: dict) -> tuple[Tokenizer, Tokenizer]:
 
     return src_tokenizer, target_tokenizer
 
+def create_batch_iter_from_dataset(
+    dataset: Dataset,
+    features: list[str],
+    batch_size: int = 10_000,
+) -> Generator[list[str], None, None]:
+    """
+    Yield sentences of ``features`` in ``dataset`` in batches of ``batch_size`` rows.
+
+    Each batch is sliced from the underlying Arrow table and converted to Python
+    objects at once, which is much cheaper than converting one row at a time.
+    """
+    for batch in dataset.select_columns(features).iter(batch_size=batch_size):
+        yield [sentence for feature in features for sentence in batch[feature]]
+
 def process_sentence(sentence: str, config: dict) -> str:
     # default actions
     sentence = sentence.strip()
-    sentence = re.sub(r'\s(&[a-zA-Z]+;)', r'\1', sentence)
+    sentence = _SPACE_BEFORE_HTML_ENTITY_RE.sub(r'\1', sentence)
     sentence = html.unescape(sentence)
 
     if is_enabled(config, Config.LOWERCASE):
         sentence = sentence.lower()
     if is_enabled(config, Config.CONTRACTIONS):
-        sentence = re.sub(r"\s('[\w\d]+)", r'\1', sentence)
+        sentence = _SPACE_BEFORE_CONTRACTION_RE.sub(r'\1', sentence)
         sentence = contractions.fix(sentence)
     if is_enabled(config, Config.VI_WORD_SEGMENTTATION):
         sentence = underthesea.word_tokenize(sentence, format='text')
@@ -74,13 +117,19 @@ def process_sentence(sentence: str, config: dict) -> str:
     return sentence
 
 def process_feature(dataset: DatasetDict, feature: str, config: dict) -> DatasetDict:
-    dataset = dataset.map(lambda examples: {
-        feature: [
-            process_sentence(sentence, config)
-            for sentence in examples[feature]
-        ]
-    }, batched=True)
-    return dataset
+    num_proc = max((os.cpu_count() or 1) // 2, 1)
+    processed_dataset = DatasetDict()
+    for split in dataset:
+        map_kwargs = {}
+        if len(dataset[split]) > _MIN_ROWS_FOR_MULTIPROCESSING:
+            map_kwargs = {'num_proc': num_proc, 'writer_batch_size': 10_000}
+        processed_dataset[split] = dataset[split].map(lambda examples: {
+            feature: [
+                process_sentence(sentence, config)
+                for sentence in examples[feature]
+            ]
+        }, batched=True, **map_kwargs)
+    return processed_dataset
 
 def process_dataset_sentences(
     dataset: DatasetDict,
@@ -95,44 +144,88 @@ def process_dataset_sentences(
 
     return dataset
 
-def _check_valid_pairs(
-    examples: dict[str, list],
+def encode_dataset_sentences(
+    dataset: DatasetDict,
     src_tokenizer: Tokenizer,
     target_tokenizer: Tokenizer,
-    max_seq_length: int,
     config: dict,
+    max_seq_length: int | None = None,
+) -> DatasetDict:
+    """
+    Encode source and target sentences once, the token ids are stored in
+    ``DatasetFeature.SRC_TOKEN_IDS`` and ``DatasetFeature.TARGET_TOKEN_IDS`` features.
+
+    If ``max_seq_length`` is given, sentences are truncated to ``max_seq_length + 1`` tokens:
+    that is enough for ``remove_invalid_pairs`` to detect (and remove) the sentences that
+    are too long, without storing all of their tokens.
+    """
+    if max_seq_length is not None:
+        # truncation is done by the tokenizers in Rust
+        src_tokenizer.enable_truncation(max_length=max_seq_length + 1)
+        target_tokenizer.enable_truncation(max_length=max_seq_length + 1)
+
+    try:
+        # `encode_batch` already encodes the sentences of a batch in parallel.
+        # the result is kept in memory, as it is saved to `dataset_save_path` anyway and writing
+        # cache files would fill the directory of the (cached) input dataset with one file per setting
+        return dataset.map(lambda examples: {
+            DatasetFeature.SRC_TOKEN_IDS: [
+                encoding.ids
+                for encoding in src_tokenizer.encode_batch(examples[config['source']])
+            ],
+            DatasetFeature.TARGET_TOKEN_IDS: [
+                encoding.ids
+                for encoding in target_tokenizer.encode_batch(examples[config['target']])
+            ],
+        }, batched=True, batch_size=1000, keep_in_memory=True)
+    finally:
+        src_tokenizer.no_truncation()
+        target_tokenizer.no_truncation()
+
+def get_token_lengths(dataset: Dataset, feature: str) -> np.ndarray:
+    """
+    Return the number of tokens of each row in the token ids ``feature`` of ``dataset``
+    """
+    token_ids = dataset.with_format('arrow')[feature]
+    return pc.list_value_length(token_ids).to_numpy()
+
+def _check_valid_pairs(
+    src_token_ids: list[list[int]],
+    target_token_ids: list[list[int]],
+    max_seq_length: int,
 ) -> list[bool]:
-    if len(examples[config['source']]) != len(examples[config['target']]):
+    if len(src_token_ids) != len(target_token_ids):
         raise ValueError('The number of source and target examples must be equal')
 
-    valid_row = [True] * len(examples[config['source']])
-    for row_id, (source, target) in enumerate(zip(examples[config['source']], examples[config['target']])):
-        src_tokens_len = len(src_tokenizer.encode(source).ids)
-        target_tokens_len = len(target_tokenizer.encode(target).ids)
+    valid_row = [True] * len(src_token_ids)
+    for row_id, (src_ids, target_ids) in enumerate(zip(src_token_ids, target_token_ids)):
+        src_tokens_len = len(src_ids)
+        target_tokens_len = len(target_ids)
         valid_row[row_id] = min(src_tokens_len, target_tokens_len) > 0 and \
                             max(src_tokens_len, target_tokens_len) <= max_seq_length
 
     return valid_row
 
-def remove_invalid_pairs(
-    dataset: DatasetDict,
-    src_tokenizer: Tokenizer,
-    target_tokenizer: Tokenizer,
-    max_seq_length: int,
-    config: dict,
-) -> DatasetDict:
-    return dataset.filter(lambda examples: _check_valid_pairs(
-        examples,
-        src_tokenizer,
-        target_tokenizer,
-        max_seq_length,
-        config,
-    ), batched=True)
+def remove_invalid_pairs(dataset: DatasetDict, max_seq_length: int) -> DatasetDict:
+    """
+    Remove pairs that are empty or longer than ``max_seq_length`` tokens,
+    lengths are read from the token ids computed by ``encode_dataset_sentences``
+    """
+    return dataset.filter(
+        lambda src_token_ids, target_token_ids: _check_valid_pairs(
+            src_token_ids,
+            target_token_ids,
+            max_seq_length,
+        ),
+        batched=True,
+        input_columns=[DatasetFeature.SRC_TOKEN_IDS, DatasetFeature.TARGET_TOKEN_IDS],
+        keep_in_memory=True,  # same as in `encode_dataset_sentences`
+    )
 
 class CollatorWithPadding:
-    def __init__(self, padding_value: int, added_features: list[str] = []) -> None:
+    def __init__(self, padding_value: int, added_features: list[str] | None = None) -> None:
         self.padding_value = padding_value
-        self.added_features = added_features
+        self.added_features = added_features if added_features is not None else []
 
     def __call__(self, original_batch: list[dict[str, Any]]) -> dict[str, Any]:
         all_features = original_batch[0].keys()
@@ -140,9 +233,51 @@ class CollatorWithPadding:
 
         feature_dict = {key: [item[key] for item in original_batch] for key in self.added_features}
         batch = {key: [item[key] for item in original_batch] for key in remain_features}
-        feature_dict = {
-            key: pad_sequence(value, batch_first=True, padding_value=self.padding_value)
-            for key, value in feature_dict.items()
-        }
+        feature_dict = {key: self._pad(value) for key, value in feature_dict.items()}
         batch.update(feature_dict)
         return batch
+
+    def _pad(self, tensors: list[Tensor]) -> Tensor:
+        # items that already have the same length (e.g. padded by the dataset) only need to be stacked
+        if all(tensor.size(0) == tensors[0].size(0) for tensor in tensors):
+            return torch.stack(tensors)
+        return pad_sequence(tensors, batch_first=True, padding_value=self.padding_value)
+
+class LengthBucketSampler(Sampler[list[int]]):
+    """
+    Batch sampler that groups examples of similar lengths into the same batch.
+
+    Examples are sorted by their lengths, with a small random noise added when ``shuffle``
+    is enabled so that batches differ between epochs, then split into batches
+    whose order is shuffled.
+    """
+    def __init__(
+        self,
+        lengths: np.ndarray,
+        batch_size: int,
+        shuffle: bool = True,
+        noise: int = 8,
+    ) -> None:
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.noise = noise
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self) -> Iterator[list[int]]:
+        if self.shuffle:
+            # shuffle first, so that examples with the same length are not always in the same order
+            indices = np.random.permutation(len(self.lengths))
+            noisy_lengths = self.lengths[indices] + np.random.randint(0, self.noise, size=len(indices))
+            indices = indices[np.argsort(noisy_lengths, kind='stable')]
+        else:
+            indices = np.argsort(self.lengths, kind='stable')
+
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+
+        for batch in batches:
+            yield batch.tolist()
@@ -289,9 +289,9 @@ def evaluate(
     model.eval()
 
     for batch in batch_iterator:
-        encoder_input = batch['encoder_input'].to(device)  # (batch_size, seq_length)
-        decoder_input = batch['decoder_input'].to(device)  # (batch_size, seq_length)
-        labels = batch['labels'].to(device)  # (batch_size, seq_length)
+        encoder_input = batch['encoder_input'].to(device, non_blocking=True)  # (batch_size, seq_length)
+        decoder_input = batch['decoder_input'].to(device, non_blocking=True)  # (batch_size, seq_length)
+        labels = batch['labels'].to(device, non_blocking=True)  # (batch_size, seq_length)
 
         decoder_output = model(encoder_input, decoder_input)  # (batch_size, seq_length, d_model)
         logits = model.linear_transform(decoder_output)  # (batch_size, seq_length, target_vocab_size)
@@ -1,6 +1,6 @@
 import numpy as np
 
-from sklearn.metrics import accuracy_score, precision_recall_fscore_support
+import torch
 from torch import Tensor
 from torch.utils.tensorboard import SummaryWriter
 
@@ -20,8 +20,6 @@ class Stats:
 
         self.num_batchs = num_batchs
         self.loss = loss
-        self.pred = pred if pred is not None else []
-        self.labels = labels if labels is not None else []
         self.f_score_beta = f_score_beta
         self.average = average
 
@@ -30,6 +28,64 @@ class Stats:
             raise ValueError("pad_token_id must be provided if ignore_padding is True")
         self.pad_token_id = pad_token_id
 
+        # instead of keeping every prediction, only per-class counts are accumulated, i.e.
+        # the diagonal and the marginals of the confusion matrix, which is all precision,
+        # recall and f-score need. The arrays grow when a larger token id is seen
+        self.true_positives = np.zeros(0, dtype=np.int64)
+        self.pred_counts = np.zeros(0, dtype=np.int64)
+        self.label_counts = np.zeros(0, dtype=np.int64)
+        for y_pred, y_true in zip(pred or [], labels or []):
+            self._accumulate(y_pred.ravel(), y_true.ravel())
+
+        # counts of tensor inputs are accumulated on their device (true positives, predictions
+        # and labels), and only moved to the host and merged into the arrays above in `compute`
+        self._device_counts: list[Tensor] | None = None
+
+    def __getstate__(self) -> dict:
+        self._merge_device_counts()
+        return self.__dict__.copy()
+
+    def __setstate__(self, state: dict) -> None:
+        # stats pickled in older checkpoints keep every prediction in `pred` and `labels`
+        # instead of per-class counts, rebuild the counts from them
+        legacy_pred = state.pop('pred', None)
+        legacy_labels = state.pop('labels', None)
+        self.__dict__.update(state)
+        self._device_counts = None
+        if 'true_positives' not in state:
+            self.true_positives = np.zeros(0, dtype=np.int64)
+            self.pred_counts = np.zeros(0, dtype=np.int64)
+            self.label_counts = np.zeros(0, dtype=np.int64)
+            for y_pred, y_true in zip(legacy_pred or [], legacy_labels or []):
+                self._accumulate(np.asarray(y_pred).ravel(), np.asarray(y_true).ravel())
+
+    def _accumulate(self, y_pred: np.ndarray, y_true: np.ndarray) -> None:
+        self.true_positives = _add_counts(self.true_positives, y_true[y_pred == y_true])
+        self.pred_counts = _add_counts(self.pred_counts, y_pred)
+        self.label_counts = _add_counts(self.label_counts, y_true)
+
+    def _accumulate_on_device(self, y_pred: Tensor, y_true: Tensor) -> None:
+        values = (y_true[y_pred == y_true], y_pred, y_true)
+        if self._device_counts is None:
+            self._device_counts = [torch.bincount(v) for v in values]
+            return
+        self._device_counts = [
+            _add_device_counts(counts, v)
+            for counts, v in zip(self._device_counts, values)
+        ]
+
+    def _merge_device_counts(self) -> None:
+        if self._device_counts is None:
+            return
+        true_positives, pred_counts, label_counts = (
+            counts.cpu().numpy()
+            for counts in self._device_counts
+        )
+        self.true_positives = _merge_counts(self.true_positives, true_positives)
+        self.pred_counts = _merge_counts(self.pred_counts, pred_counts)
+        self.label_counts = _merge_counts(self.label_counts, label_counts)
+        self._device_counts = None
+
     def update_step(
         self,
         loss: float,
@@ -40,32 +96,41 @@ class Stats:
         self.num_batchs += 1
 
         if isinstance(y_pred, Tensor):
-            y_pred = y_pred.cpu().detach().numpy()
+            y_pred = y_pred.detach()
         if isinstance(y_true, Tensor):
-            y_true = y_true.cpu().detach().numpy()
+            y_true = y_true.detach()
 
         y_pred = y_pred.ravel()
         y_true = y_true.ravel()
 
         if self.ignore_padding:
-            y_pred = y_pred[y_true != self.pad_token_id]
-            y_true = y_true[y_true != self.pad_token_id]
+            mask = y_true != self.pad_token_id
+            y_pred = y_pred[mask]
+            y_true = y_true[mask]
 
-        self.pred.append(y_pred)
-        self.labels.append(y_true)
+        if isinstance(y_pred, Tensor) and isinstance(y_true, Tensor):
+            self._accumulate_on_device(y_pred, y_true)
+            return
 
-    def compute(self) -> dict[str, float]:
-        y_pred = np.concatenate(self.pred)
-        y_true = np.concatenate(self.labels)
+        if isinstance(y_pred, Tensor):
+            y_pred = y_pred.cpu().numpy()
+        if isinstance(y_true, Tensor):
+            y_true = y_true.cpu().numpy()
+        self._accumulate(y_pred, y_true)
 
+    def compute(self) -> dict[str, float]:
+        self._merge_device_counts()
         loss = self.loss / self.num_batchs
-        acc = accuracy_score(y_true, y_pred)  # this calculation does not take into account the padding tokens
-        precision, recall, f_beta, _ = precision_recall_fscore_support(
-            y_true,
-            y_pred,
+        # this calculation does not take into account the padding tokens
+        # (number of matches is the sum of true positives)
+        acc = _safe_divide(self.true_positives.sum(), self.label_counts.sum())
+
+        precision, recall, f_beta = precision_recall_fscore(
+            self.true_positives,
+            self.pred_counts,
+            self.label_counts,
             beta=self.f_score_beta,
             average=self.average,
-            zero_division=0.0,
         )
         return {
             'loss': loss,
@@ -88,3 +153,102 @@ class Stats:
             writer.add_scalars(f'{prefix}/{metric_name}', {
                 name: score
             }, step)
+
+def precision_recall_fscore(
+    true_positives: np.ndarray,
+    pred_counts: np.ndarray,
+    label_counts: np.ndarray,
+    beta: float = 1.0,
+    average: str = 'weighted',
+) -> tuple[float, float, float]:
+    """
+    Compute the averaged precision, recall and f-beta score from per-class counts,
+    same as sklearn's ``precision_recall_fscore_support`` with ``zero_division=0.0``
+
+    Args:
+        true_positives (np.ndarray): number of correct predictions of each class
+        pred_counts (np.ndarray): number of predictions of each class
+        label_counts (np.ndarray): number of labels (support) of each class
+        beta (float): beta of the f-score (default: 1.0)
+        average (str): possible values are "micro", "macro", "weighted" (default: "weighted")
+
+    Returns:
+        tuple[float, float, float]: precision, recall and f-beta score
+    """
+    if average not in ('micro', 'macro', 'weighted'):
+        raise ValueError(
+            f'Unsupported average type: {average}. '
+            'Possible values are "micro", "macro", "weighted".'
+        )
+
+    beta2 = beta ** 2
+    num_true_positives = true_positives.sum()
+    num_labels = label_counts.sum()
+    if average == 'micro':
+        precision = _safe_divide(num_true_positives, pred_counts.sum())
+        recall = _safe_divide(num_true_positives, num_labels)
+        f_beta = _safe_divide((1 + beta2) * precision * recall, beta2 * precision + recall)
+        return precision, recall, f_beta
+
+    num_classes = max(true_positives.size, pred_counts.size, label_counts.size)
+    true_positives = _pad_counts(true_positives, num_classes)
+    pred_counts = _pad_counts(pred_counts, num_classes)
+    label_counts = _pad_counts(label_counts, num_classes)
+
+    precisions = _safe_divide(true_positives, pred_counts)
+    # same as (1 + beta^2) * precision * recall / (beta^2 * precision + recall) of each class,
+    # without the per-class recalls
+    f_betas = _safe_divide((1 + beta2) * true_positives, beta2 * label_counts + pred_counts)
+    if average == 'weighted':
+        # weighted by supports, so the recall of each class times its weight is just its true positives
+        precision = _safe_divide(precisions @ label_counts, num_labels)
+        recall = _safe_divide(num_true_positives, num_labels)
+        f_beta = _safe_divide(f_betas @ label_counts, num_labels)
+    else:
+        # only classes that appear in either predictions or labels
+        present = (pred_counts > 0) | (label_counts > 0)
+        num_present = np.count_nonzero(present)
+        recalls = _safe_divide(true_positives[present], label_counts[present])
+        precision = _safe_divide(precisions[present].sum(), num_present)
+        recall = _safe_divide(recalls.sum(), num_present)
+        f_beta = _safe_divide(f_betas[present].sum(), num_present)
+
+    return precision, recall, f_beta
+
+def _add_counts(counts: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """
+    Add the number of occurrences of each value in ``values`` to ``counts``,
+    ``counts`` is enlarged if ``values`` contains a value out of its range
+    """
+    if values.size == 0:
+        return counts
+    new_counts = np.bincount(values)
+    if new_counts.size > counts.size:
+        new_counts[:counts.size] += counts
+        return new_counts
+    counts[:new_counts.size] += new_counts
+    return counts
+
+def _add_device_counts(counts: Tensor, values: Tensor) -> Tensor:
+    new_counts = torch.bincount(values, minlength=counts.numel())
+    new_counts[:counts.numel()] += counts
+    return new_counts
+
+def _merge_counts(counts: np.ndarray, other_counts: np.ndarray) -> np.ndarray:
+    size = max(counts.size, other_counts.size)
+    return _pad_counts(counts, size) + _pad_counts(other_counts, size)
+
+def _pad_counts(counts: np.ndarray, size: int) -> np.ndarray:
+    return np.pad(counts, (0, size - counts.size))
+
+def _safe_divide(numerator, denominator):
+    """
+    Element-wise division, where zero is returned if the denominator is zero
+    """
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    result = np.zeros(np.broadcast(numerator, denominator).shape, dtype=np.float64)
+    np.divide(numerator, denominator, out=result, where=(denominator != 0))
+    if result.ndim == 0:
+        return float(result)
+    return result